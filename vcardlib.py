@@ -14,8 +14,8 @@ vCard and VCF files from version 2.1 to 3.0 (even large ones)."""
 
 import logging
 import re
-import warnings
 import binascii
+import os
 from os.path import exists, basename
 from email.utils import parseaddr
 # @see: https://eventable.github.io/vobject/
@@ -23,11 +23,9 @@ from vobject import vCard, readComponents
 from vobject.vcard import Name
 from vobject.base import Component, ContentLine, ParseError
 
-# prevent the import of fuzzywuzzy to raise a UserWarning
-with warnings.catch_warnings():
-    warnings.simplefilter("ignore")
-    # @see: https://github.com/seatgeek/fuzzywuzzy
-    from fuzzywuzzy.fuzz import token_sort_ratio
+# @see: https://github.com/rapidfuzz/RapidFuzz
+from rapidfuzz.fuzz import token_sort_ratio
+from rapidfuzz.utils import default_process
 
 # when building a name from an email,
 # if the email left part (of '@') startswith one of the following
@@ -61,6 +59,8 @@ REGEX_EMAIL_SURROUNDINGS = [
 REGEX_EMAIL_WITH_NAME = re.compile('^ *"[^"]+" *<(?P<email>[^>]+)> *$')
 REGEX_INVALID_MAIL = re.compile('^nobody[a-z0-9]*@nowhere.invalid$')
 REGEX_ONY_NON_ALPHANUM = re.compile('^[ 	]*[^\\w]*[ 	]*$')
+# characters removed before fuzzy matching (like fuzzywuzzy's 'force_ascii' did)
+FUZZY_REMOVED_CHARS = dict.fromkeys(range(128, 256))
 
 # global options that can be changed by invoking the command line
 OPTION_MATCH_ATTRIBUTES = ['names', 'tel_!work', 'email']
@@ -68,7 +68,7 @@ OPTION_NO_MATCH_APPROX = False
 OPTION_MATCH_APPROX_SAME_FIRST_LETTER = True
 OPTION_MATCH_APPROX_STARTSWITH = False
 OPTION_MATCH_APPROX_MIN_LENGTH = 5
-OPTION_MATCH_APPROX_MAX_DISTANCE = range(-3, 3)
+OPTION_MATCH_APPROX_MAX_DISTANCE = 3
 OPTION_MATCH_APPROX_RATIO = 100
 OPTION_UPDATE_GROUP_KEY = True
 OPTION_FRENCH_TWEAKS = False
@@ -76,6 +76,42 @@ OPTION_DO_NOT_FORCE_ESCAPE_COMMAS = False
 
 SINGLE_INSTANCE_PROPERTIES = {'prodid', 'rev', 'uid'}
 
+
+def configure(match_attributes=None, no_match_approx=None, \
+  match_approx_same_first_letter=None, match_approx_startswith=None, \
+  match_approx_min_length=None, match_approx_max_distance=None, match_approx_ratio=None, \
+  french_tweaks=None, do_not_force_escape_commas=None \
+):  # pylint: disable=too-many-arguments,too-many-branches
+    """
+    Return void.
+
+    Set the global options all at once.
+    An option that is not specified (None) keeps its current value.
+    """
+    global OPTION_MATCH_ATTRIBUTES, OPTION_NO_MATCH_APPROX
+    global OPTION_MATCH_APPROX_SAME_FIRST_LETTER, OPTION_MATCH_APPROX_STARTSWITH
+    global OPTION_MATCH_APPROX_MIN_LENGTH, OPTION_MATCH_APPROX_MAX_DISTANCE
+    global OPTION_MATCH_APPROX_RATIO, OPTION_FRENCH_TWEAKS, OPTION_DO_NOT_FORCE_ESCAPE_COMMAS
+
+    if match_attributes is not None:
+        OPTION_MATCH_ATTRIBUTES = match_attributes
+    if no_match_approx is not None:
+        OPTION_NO_MATCH_APPROX = no_match_approx
+    if match_approx_same_first_letter is not None:
+        OPTION_MATCH_APPROX_SAME_FIRST_LETTER = match_approx_same_first_letter
+    if match_approx_startswith is not None:
+        OPTION_MATCH_APPROX_STARTSWITH = match_approx_startswith
+    if match_approx_min_length is not None:
+        OPTION_MATCH_APPROX_MIN_LENGTH = match_approx_min_length
+    if match_approx_max_distance is not None:
+        OPTION_MATCH_APPROX_MAX_DISTANCE = match_approx_max_distance
+    if match_approx_ratio is not None:
+        OPTION_MATCH_APPROX_RATIO = match_approx_ratio
+    if french_tweaks is not None:
+        OPTION_FRENCH_TWEAKS = french_tweaks
+    if do_not_force_escape_commas is not None:
+        OPTION_DO_NOT_FORCE_ESCAPE_COMMAS = do_not_force_escape_commas
+
 def add_attributes(attributes, attr_to_add):  # pylint: disable=too-many-branches
     """
     Return void
@@ -258,7 +294,7 @@ def sanitize_name(name):
             .title())
         outer = REGEX_ANYTHING_BETWEEN_PARENTH_OR_BRACES.sub('', name).strip().title()
         # match even words in a different order
-        if inner == outer or token_sort_ratio(inner, outer) == 100:
+        if inner == outer or token_sort_ratio(inner, outer, processor=fuzzy_process) == 100:
             sanitized = outer
     return sanitized
 
@@ -697,24 +733,28 @@ def write_vcard_to_file(vcard, file_path):
         raise TypeError("parameter 'file_path' must be a string "
                         "(type: '" + str(type(file_path)) + "')")
 
-    # serialize the vcard to produce a string content
-    file_content = vcard.serialize()
+    # serialize the vcard to produce the file content
+    file_content = vcard.serialize().encode('utf-8')
 
     # check if the file already exists
     if exists(file_path): # should not happen
         raise RuntimeError("Failed to write vcard to file '" + file_path + "' : "
                            "file already exists.")
 
-    # open file in write mode
-    with open(file_path, 'w') as c_file:
-        try:
-            # write to it
-            c_file.write(file_content)
-            logging.debug("Writen vCard file '%s'", file_path)
-        except OSError as err:
-            logging.error("Failed to write file '%s'", file_path)
-            logging.error(err)
-            raise
+    # open file in exclusive creation mode (files may be written concurrently)
+    c_fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    try:
+        # write the whole content to it (usually in a single syscall)
+        content_view = memoryview(file_content)
+        while content_view:
+            content_view = content_view[os.write(c_fd, content_view):]
+        logging.debug("Writen vCard file '%s'", file_path)
+    except OSError as err:
+        logging.error("Failed to write file '%s'", file_path)
+        logging.error(err)
+        raise
+    finally:
+        os.close(c_fd)
     logging.debug("\tWriten vCard to file '%s'", file_path)
 
 
@@ -840,16 +880,16 @@ def normalize(vcard, selected_name, \
     # TODO: strip all values
 
 
-def get_vcards_from_files(files, \
+def iter_vcards_from_files(files, \
   do_not_fix_and_convert=False, \
   do_not_overwrite_names=False, \
   mv_name_parenth_braces_to_note=False, \
   do_not_remove_name_in_email=False \
 ):  # pylint: disable=too-many-locals
     """
-    Return a dict of vobject.vcard.
+    Yield (key, vobject.vcard) tuples, one vCard at a time, as they are parsed.
 
-    vCards will be normalized.
+    vCards will be normalized. Keys are unique (an index is appended to already used names).
 
     arguments:
     files -- a list of the vcf/vcard files to read from
@@ -864,7 +904,7 @@ def get_vcards_from_files(files, \
 
     # read all files
     logging.info("Reading/parsing individual vCard files ...")
-    vcards = {}
+    vcards_keys = set()
     file_names_max_length = max([len(basename(x)) for x in files])
     selected_name = None
     logging.debug("file names max length: %d", file_names_max_length)
@@ -907,16 +947,17 @@ def get_vcards_from_files(files, \
                     raise
 
                 # increment the name if already used
-                if selected_name in vcards:
+                if selected_name in vcards_keys:
                     index = 0
                     name_indexed = selected_name
-                    while name_indexed in vcards:
+                    while name_indexed in vcards_keys:
                         index += 1
                         name_indexed = selected_name + "(" + str(index) + ")"
                     selected_name = name_indexed
 
-                # add the card to the list
-                vcards[selected_name] = vcard
+                # provide the card
+                vcards_keys.add(selected_name)
+                yield selected_name, vcard
 
             # sum up the parsing for that file
             logging.info(
@@ -947,7 +988,20 @@ def get_vcards_from_files(files, \
                     "and if needed exclude it from the batch and re-run it.")
             raise
 
-    return vcards
+
+def get_vcards_from_files(files, \
+  do_not_fix_and_convert=False, \
+  do_not_overwrite_names=False, \
+  mv_name_parenth_braces_to_note=False, \
+  do_not_remove_name_in_email=False \
+):
+    """
+    Return a dict of vobject.vcard.
+
+    vCards will be normalized (see: iter_vcards_from_files).
+    """
+    return dict(iter_vcards_from_files(files, do_not_fix_and_convert, do_not_overwrite_names,
+                                       mv_name_parenth_braces_to_note, do_not_remove_name_in_email))
 
 
 def deduplicate(vcard):
@@ -1318,6 +1372,25 @@ def reverse_words(string):
     return reverse_name.family + ' ' + reverse_name.given
 
 
+def fuzzy_process(string):
+    """
+    Return the string processed for fuzzy matching.
+
+    Like fuzzywuzzy did: Latin-1 non-ASCII characters (i.e.: accents) are removed,
+    then the string is lower cased and its non alphanumeric characters are replaced by spaces.
+    """
+    return default_process(string.translate(FUZZY_REMOVED_CHARS))
+
+
+def token_sort_key(string):
+    """
+    Return the string processed and with its words sorted.
+
+    Two strings have a token_sort_ratio of 100 only if they have the same (non-empty) key.
+    """
+    return ' '.join(sorted(fuzzy_process(string).split()))
+
+
 def match_approx(reference, compared):  # pylint: disable=too-many-branches,too-many-return-statements
     """
     Return True if 'reference' match 'compared'.
@@ -1338,46 +1411,66 @@ def match_approx(reference, compared):  # pylint: disable=too-many-branches,too-
         raise TypeError("parameter 'compared' must be a string "
                         "(type: '" + str(type(compared)) + "')")
 
+    # names without any alphanumeric character can't be compared
+    # (rapidfuzz scores two empty strings 100, and they have no blocking key)
+    if not fuzzy_process(reference) or not fuzzy_process(compared):
+        return False
+
     # safe approximate matching
     if OPTION_MATCH_APPROX_RATIO == 100:
-        score = token_sort_ratio(reference, compared)
+        score = token_sort_ratio(reference, compared, processor=fuzzy_process)
         if score == 100:
             logging.debug("\t'%s' ~ '%s' (score: 100)", reference, compared)
             return True
 
+    # with the safe ratio, the fuzzy comparizon below would be the same as the one above
+    # so only the "startswith" comparizon could match
+    if OPTION_MATCH_APPROX_RATIO == 100 and not OPTION_MATCH_APPROX_STARTSWITH:
+        return False
+
     # ensure a minimal length when doing unsafe approximate match
     if (len(reference) > OPTION_MATCH_APPROX_MIN_LENGTH
             and len(compared) > OPTION_MATCH_APPROX_MIN_LENGTH):
 
-        # build reversed words names
-        if OPTION_MATCH_APPROX_SAME_FIRST_LETTER or OPTION_MATCH_APPROX_STARTSWITH:
+        # reversed words names are costly to build, so they are built only when required
+        reference_reversed = None
+        compared_reversed = None
+
+        # ensure the same first letter (reverse is ok too), if required
+        if OPTION_MATCH_APPROX_SAME_FIRST_LETTER \
+        and reference[:1].lower() != compared[:1].lower():
             reference_reversed = reverse_words(reference)
             compared_reversed = reverse_words(compared)
+            if reference[:1].lower() != compared_reversed[:1].lower() \
+            and reference_reversed[:1].lower() != compared[:1].lower():
+                return False
+
+        # "startswith" comparizon, with a maximum distance
+        if OPTION_MATCH_APPROX_STARTSWITH \
+        and -OPTION_MATCH_APPROX_MAX_DISTANCE <= len(reference) - len(compared) \
+            <= OPTION_MATCH_APPROX_MAX_DISTANCE:
+            if reference.startswith(compared):
+                logging.debug("\t'%s' startswith '%s'", reference, compared)
+                return True
+            if compared.startswith(reference):
+                logging.debug("\t'%s' startswith '%s'", compared, reference)
+                return True
+            if reference_reversed is None:
+                reference_reversed = reverse_words(reference)
+                compared_reversed = reverse_words(compared)
+            if reference_reversed.startswith(compared):
+                logging.debug("\t'%s' reverse startswith '%s'", reference, compared)
+                return True
+            if compared_reversed.startswith(reference):
+                logging.debug("\t'%s' reverse startswith '%s'", compared, reference)
+                return True
 
-        # ensure the same first letter (reverse is ok too), if required
-        if not OPTION_MATCH_APPROX_SAME_FIRST_LETTER \
-        or reference[:1].lower() == compared[:1].lower() \
-        or reference[:1].lower() == compared_reversed[:1].lower() \
-        or reference_reversed[:1].lower() == compared[:1].lower():
-
-            # "startswith" comparizon, with a maximum distance
-            if OPTION_MATCH_APPROX_STARTSWITH \
-            and len(reference) - len(compared) in OPTION_MATCH_APPROX_MAX_DISTANCE:
-                if reference.startswith(compared):
-                    logging.debug("\t'%s' startswith '%s'", reference, compared)
-                    return True
-                elif compared.startswith(reference):
-                    logging.debug("\t'%s' startswith '%s'", compared, reference)
-                    return True
-                elif reference_reversed.startswith(compared):
-                    logging.debug("\t'%s' reverse startswith '%s'", reference, compared)
-                    return True
-                elif compared_reversed.startswith(reference):
-                    logging.debug("\t'%s' reverse startswith '%s'", compared, reference)
-                    return True
-
-            # fuzzy comparizon, based on token_sort_ratio (others are not accurate)
-            score = token_sort_ratio(reference, compared)
+        # fuzzy comparizon, based on token_sort_ratio (others are not accurate)
+        # note: the score cutoff let rapidfuzz bail out early (i.e.: on too large length delta)
+        if OPTION_MATCH_APPROX_RATIO != 100:
+            # note: scores are rounded to an integer (like fuzzywuzzy did)
+            score = round(token_sort_ratio(reference, compared, processor=fuzzy_process,
+                                           score_cutoff=OPTION_MATCH_APPROX_RATIO - 0.5))
             if score >= OPTION_MATCH_APPROX_RATIO:
                 logging.debug("\t'%s' ~ '%s' (score: %d)", reference, compared, score)
                 return True
@@ -1386,12 +1479,61 @@ def match_approx(reference, compared):  # pylint: disable=too-many-branches,too-
     return False
 
 
+def find_group_root(mappings, key):
+    """
+    Return the root vcard key of the group containing the vcard key.
+
+    The path from the vcard key to the root is compressed along the way.
+    """
+    parents = mappings['vcard_parent']
+    root = key
+    while parents[root] != root:
+        root = parents[root]
+    while parents[key] != root:
+        parents[key], key = root, parents[key]
+    return root
+
+
+def get_vcard_group(mappings, key):
+    """ Return the name of the group containing the vcard key, or None if it has no group. """
+
+    if key not in mappings['vcard_parent']:
+        return None
+    return mappings['group_name'][find_group_root(mappings, key)]
+
+
+def union_vcard_groups(mappings, key1, key2, group_name):
+    """
+    Return void.
+
+    Make the vcard keys belong to the same group (disjoint-set union by rank),
+    and name that group with the specified group name.
+    """
+    parents = mappings['vcard_parent']
+    ranks = mappings['vcard_rank']
+    for key in (key1, key2):
+        if key not in parents:
+            parents[key] = key
+            ranks[key] = 0
+
+    root1 = find_group_root(mappings, key1)
+    root2 = find_group_root(mappings, key2)
+    if root1 != root2:
+        if ranks[root1] < ranks[root2]:
+            root1, root2 = root2, root1
+        parents[root2] = root1
+        if ranks[root1] == ranks[root2]:
+            ranks[root1] += 1
+        mappings['group_name'].pop(root2, None)
+    mappings['group_name'][root1] = group_name
+
+
 def group_keys(mappings, key1, key2, group1, group2):  # pylint: disable=too-many-branches
     """
     Return a string containing the name of the group containing the keys.
 
     Add the keys to a group into mappings['groups'][selected_group_name]
-    and set the vcard group in mappings['vcard_group'][key]
+    and make them belong to the same group (see: union_vcard_groups)
     """
 
     if not isinstance(mappings, dict):
@@ -1450,8 +1592,6 @@ def group_keys(mappings, key1, key2, group1, group2):  # pylint: disable=too-man
             if new_group_key != exiting_group and OPTION_UPDATE_GROUP_KEY:
                 mappings['groups'][new_group_key] = mappings['groups'][exiting_group]
                 del mappings['groups'][exiting_group]
-                for k in mappings['groups'][new_group_key]:
-                    mappings['vcard_group'][k] = new_group_key
                 selected_group = new_group_key
                 logging.debug("\t\t\tupdated group '%s' to '%s'", exiting_group, new_group_key)
 
@@ -1464,17 +1604,15 @@ def group_keys(mappings, key1, key2, group1, group2):  # pylint: disable=too-man
 
             # merge/move the other group into the selected one
             logging.debug("\t\t\told group: %s", mappings['groups'][other_group_key])
-            for k in mappings['groups'][other_group_key]:
-                mappings['vcard_group'][k] = dest_group_key
-                mappings['groups'][dest_group_key].append(k)
+            mappings['groups'][dest_group_key].extend(mappings['groups'][other_group_key])
             del mappings['groups'][other_group_key]
             selected_group = dest_group_key
             logging.debug("\t\t\tnew group: %s", mappings['groups'][selected_group])
             logging.debug("\t\t\tmerged group '%s' into '%s'", other_group_key, dest_group_key)
 
-    # ensure the vcard group are up to date with the right vcard group
-    mappings['vcard_group'][key1] = selected_group
-    mappings['vcard_group'][key2] = selected_group
+    # ensure both vcards belong to the selected group (and that it has the right name)
+    if selected_group:
+        union_vcard_groups(mappings, key1, key2, selected_group)
 
     return selected_group
 
@@ -1487,11 +1625,15 @@ def get_vcards_groups(vcards):  # pylint: disable=too-many-statements,too-many-b
     if not isinstance(vcards, dict):
         raise TypeError("parameter 'vcards' must be a dict (type: '" + str(type(vcards)) + "')")
 
-    # After having analysed all the vcards, this structure will contains 3 related dicts.
-    #  - groups      : lists of vcards that matches together grouped by a selected group key
-    #  - vcard_group : for each vcard, the group key to which they belongs to
-    #  - attributes  : for each attributes values, a list of vcards having that value
-    mappings = {'groups': {}, 'vcard_group': {}, 'attributes': {}}
+    # After having analysed all the vcards, this structure will contains 5 related dicts.
+    #  - groups       : lists of vcards that matches together grouped by a selected group key
+    #  - vcard_parent : for each grouped vcard, its parent vcard in its group (disjoint-set forest)
+    #  - vcard_rank   : for each grouped vcard, its rank in the disjoint-set forest
+    #  - group_name   : for each group root vcard, the group key
+    #  - attributes   : for each attributes values, a list of vcards having that value
+    # note: use get_vcard_group() to get the group key to which a vcard belongs to
+    mappings = {'groups': {}, 'vcard_parent': {}, 'vcard_rank': {}, 'group_name': {},
+                'attributes': {}}
 
     # analysing all the vcards and filling the mapping/grouping dicts
     number_of_vcards = len(vcards)
@@ -1549,9 +1691,7 @@ def get_vcards_groups(vcards):  # pylint: disable=too-many-statements,too-many-b
                                 "'" + str(a_value) + "' for key "
                                 "'" + key + "' : no mapped vcard but value exists")
                         # get its group
-                        matched_vcard_group = None
-                        if matched_vcard_key in mappings['vcard_group']:
-                            matched_vcard_group = mappings['vcard_group'][matched_vcard_key]
+                        matched_vcard_group = get_vcard_group(mappings, matched_vcard_key)
                         logging.debug("\t\t\tmatched vcard group: '%s'", matched_vcard_group)
 
                         # grouping them
@@ -1591,14 +1731,36 @@ def get_vcards_groups(vcards):  # pylint: disable=too-many-statements,too-many-b
         logging.info("Comparing '%d' names (%d comparisons to make, takes a few minutes)",
                      number_of_names, number_of_comparisons)
 
+        # with the safe ratio (and without "startswith"), names can only match when they have
+        # the same token sort key, so each name is only compared to the names sharing its key
+        names_keys = None
+        names_blocks = None
+        if OPTION_MATCH_APPROX_RATIO == 100 and not OPTION_MATCH_APPROX_STARTSWITH:
+            names_keys = {}
+            names_blocks = {}
+            for name in mappings['attributes']['names']:
+                names_keys[name] = token_sort_key(name)
+                names_blocks.setdefault(names_keys[name], []).append(name)
+
         # for every name
         for name1, keys1 in mappings['attributes']['names'].items():
 
             # prevent the name from being processed again
             del names_to_compare_with[name1]
 
+            # select the names to compare with
+            if names_blocks is None:
+                names_candidates = names_to_compare_with.items()
+            else:
+                # names are processed in order, so this one is the first of its block
+                names_block = names_blocks[names_keys[name1]]
+                del names_block[0]
+                names_candidates = (
+                    ((name2, names_to_compare_with[name2]) for name2 in names_block)
+                    if names_keys[name1] else ())
+
             # search for other name matching
-            for name2, keys2 in names_to_compare_with.items():
+            for name2, keys2 in names_candidates:
 
                 # if match
                 if match_approx(name1, name2):
@@ -1606,33 +1768,28 @@ def get_vcards_groups(vcards):  # pylint: disable=too-many-statements,too-many-b
                     # getting keys and groups
                     key1 = keys1[0]
                     key2 = keys2[0] if not key1 in keys2 else key1
-                    group1 = None
-                    group2 = None
-                    if key1 in mappings['vcard_group']:
-                        group1 = mappings['vcard_group'][key1]
-                    if key2 in mappings['vcard_group']:
-                        group2 = mappings['vcard_group'][key2]
+                    group1 = get_vcard_group(mappings, key1)
+                    group2 = get_vcard_group(mappings, key2)
 
                     # grouping them
                     group_keys(mappings, key1, key2, group1, group2)
 
-                # display progress
-                comparisons_count += 1
-                percentage = int(comparisons_count * 100 / number_of_comparisons)
-                if percentage != previous_percentage:
-                    previous_percentage = percentage
-                    if percentage == 100 or percentage % display_every_percentage == 0:
-                        logging.info(
-                            ("\t{:>3d}% done\t{:>" + length_of_names_count + "d} names, "
-                             "so far").format(percentage, names_count))
+            # display progress
+            comparisons_count += len(names_to_compare_with)
+            percentage = int(comparisons_count * 100 / number_of_comparisons)
+            if percentage // display_every_percentage \
+            != previous_percentage // display_every_percentage:
+                previous_percentage = percentage
+                logging.info(
+                    ("\t{:>3d}% done\t{:>" + length_of_names_count + "d} names, "
+                     "so far").format(percentage, names_count))
 
             names_count += 1
 
     # get the not grouped vcards
     vcards_not_grouped = []
     for k in vcards.keys():
-        if not k in mappings['vcard_group']:
+        if not k in mappings['vcard_parent']:
             vcards_not_grouped.append(k)
-    #vcards_not_grouped = list(filter(lambda k: k in mappings['vcard_group'], vcards.keys()))
 
     return (mappings['groups'], vcards_not_grouped)
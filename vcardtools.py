@@ -6,13 +6,18 @@ vCard and VCF files from version 2.1 to 3.0 (even large ones)."""
 import argparse
 import logging
 import re
+from functools import lru_cache
+from operator import itemgetter
 from sys import stderr, exit as sysexit
-from os import makedirs
-from os.path import exists, isfile, split as pathsplit
+from os import makedirs, cpu_count, stat as os_stat
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from os.path import exists, normpath
+from stat import S_ISREG
 from unidecode import unidecode
 import vcardlib
 from vcardlib import (
     get_vcards_from_files,
+    iter_vcards_from_files,
     get_vcards_groups,
     collect_attributes,
     set_name,
@@ -20,10 +25,19 @@ from vcardlib import (
     write_vcard_to_file)
 
 DEFAULT_VCARD_EXTENSION = '.vcard'
+WRITE_MAX_WORKERS = min(32, (cpu_count() or 1) * 4)
+WRITE_MAX_PENDING = WRITE_MAX_WORKERS * 2
 OPTION_NO_SPACE_IN_FILENAME = False
 OPTION_FORCE_LOWER_CASE_IN_FILENAME = False
 OPTION_REPLACE_INVALID_FILENAME_CHAR_BY = '_'
 
+def filename_char(value: str) -> str:
+    """ Return the value if it is a single character (or empty), to be used in filenames.
+    """
+    if len(value) > 1:
+        raise argparse.ArgumentTypeError("'" + value + "' is not a single character")
+    return value
+
 def init_parser():
     """Setup the CLI argument parser with the definition of arguments and options."""
     parser = argparse.ArgumentParser(
@@ -79,7 +93,7 @@ def init_parser():
     )
     parser.add_argument(
         '-t', '--match-ratio', dest='match_ratio', type=int, default=100,
-        help="The ratio score to match the names (see fuzzywuzzy documentation). "
+        help="The ratio score to match the names (see rapidfuzz documentation). "
              "Default is: 100 (safe)."
     )
     parser.add_argument(
@@ -88,7 +102,8 @@ def init_parser():
     )
     parser.add_argument(
         '-d', '--match-max-distance', dest='match_max_distance', type=int, default=3,
-        help="The number of character between to length of names that matches. Default is: 3."
+        help="The maximum difference of length (at most N characters, inclusive) between "
+             "two names that match with --match-startswith. Default is: 3."
     )
     parser.add_argument(
         '-1', '--no-match-same-first-letter', dest='no_match_same_first_letter',
@@ -124,11 +139,17 @@ def init_parser():
         help="Replace upper case into lower case in generated filename"
     )
     parser.add_argument(
-        '--rep-invalid-fn-char-by', dest='rep_invalid_fn_char_by', type=str,
+        '--rep-invalid-fn-char-by', dest='rep_invalid_fn_char_by', type=filename_char,
         default=OPTION_REPLACE_INVALID_FILENAME_CHAR_BY,
-        help="Replace invalid characters in filename by the specified character. Default to '" +
+        help="Replace invalid characters in filename by the specified character "
+             "(or remove them if empty). Default to '" +
              OPTION_REPLACE_INVALID_FILENAME_CHAR_BY + "'"
     )
+    parser.add_argument(
+        '--sort-output', dest='sort_output', action='store_true',
+        help="Process the groups sorted by their directory name "
+             "(i.e.: to get a deterministic processing order)"
+    )
     parser.add_argument(
         '-l', '--log-level', dest='log_level', default='INFO',
         choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
@@ -136,44 +157,89 @@ def init_parser():
     )
     return parser
 
-def sanitise_name(a_name: str) -> str:
+@lru_cache(maxsize=None)
+def _sanitising_tables(no_space: bool, repl: str):
+    """ Return the translation table and the regex used to sanitise filenames,
+        built once for each combination of the filename options.
+
+        The table maps every invalid character to the replacement character,
+        and the regex collapses consecutive replacement characters into a single one
+        (no regex when the replacement is empty, since invalid characters are removed).
     """
-    Sanitises a filename by converting it to lowercase, removing accents, and replacing invalid characters.
-    Allows or disallows spaces based on the 'OPTION_NO_SPACE_IN_FILENAME' option.
+    # Define characters that are invalid in filenames
+    invalid_characters = r'.\\/"\'!@#?$%^&*|(){};:<>[]'
+    if no_space:
+        invalid_characters = ' ' + invalid_characters
 
-    Args:
-    - a_name: The original filename to be sanitised.
+    return (str.maketrans({c: repl for c in invalid_characters}),
+            re.compile(re.escape(repl) + '+') if repl else None)
 
-    Returns:
-    - The sanitised filename.
+@lru_cache(maxsize=4096)
+def _sanitise_cached(a_name: str, no_space: bool, lower: bool, repl: str) -> str:
+    """ Sanitise a filename, the options being passed explicitly so they are part of the cache key.
     """
+    trans_table, collapse_repl_re = _sanitising_tables(no_space, repl)
+
     # Convert to ASCII and remove accents
     sanitised = unidecode(a_name)
 
-    if OPTION_FORCE_LOWER_CASE_IN_FILENAME:
+    if lower:
         sanitised = sanitised.lower()
 
-    # Define characters that are invalid in filenames
-    invalid_characters = r'.\\/"\'!@#?$%^&*|(){};:<>[]'
-    if OPTION_NO_SPACE_IN_FILENAME:
-        invalid_characters = ' ' + invalid_characters
-
     # Replace all invalid characters with the specified replacement character
-    sanitised = re.sub(f'[{re.escape(invalid_characters)}]+', OPTION_REPLACE_INVALID_FILENAME_CHAR_BY, sanitised)
+    # (unidecode produced pure ASCII, so a translation table is enough)
+    sanitised = sanitised.translate(trans_table)
 
     # Replace multiple consecutive replacement characters with a single one
-    return re.sub(f'{re.escape(OPTION_REPLACE_INVALID_FILENAME_CHAR_BY)}+', OPTION_REPLACE_INVALID_FILENAME_CHAR_BY, sanitised)
+    if collapse_repl_re:
+        sanitised = collapse_repl_re.sub(repl, sanitised)
+    return sanitised
+
+def sanitise_name(a_name: str) -> str:
+    """
+    Sanitises a filename by converting it to lowercase, removing accents, and replacing invalid characters.
+    Allows or disallows spaces based on the 'OPTION_NO_SPACE_IN_FILENAME' option.
+    Results are cached, since the same names are sanitised multiple times (groups and vCards).
+
+    Args:
+    - a_name: The original filename to be sanitised.
+
+    Returns:
+    - The sanitised filename.
+    """
+    return _sanitise_cached(a_name, OPTION_NO_SPACE_IN_FILENAME,
+                            OPTION_FORCE_LOWER_CASE_IN_FILENAME, OPTION_REPLACE_INVALID_FILENAME_CHAR_BY)
 
 def generate_vcard_filename(a_name: str = '', ext: str = '') -> str:
     """ Make a vcard filename, by first sanitising the filename
         and then adding the defined extension.
     """
-    return sanitise_name(a_name=a_name) + ext
+    return sanitise_name(a_name) + ext
 
 def generate_group_dirname(a_name: str = '') -> str:
     """ Return a group name, sanitised
     """
-    return sanitise_name(a_name=a_name)
+    return sanitise_name(a_name)
+
+def write_vcards_to_files(vcard_files) -> int:
+    """ Write every (vcard, file path) pair to its file, using a pool of threads
+        since each write is independent and mostly waiting for I/O.
+        Only a few writes are pending at a time, so 'vcard_files' can be a lazy iterable.
+        Return the number of vCard files written.
+    """
+    count = 0
+    pending = set()
+    with ThreadPoolExecutor(max_workers=WRITE_MAX_WORKERS) as executor:
+        for vcard, file_path in vcard_files:
+            if len(pending) >= WRITE_MAX_PENDING:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+            pending.add(executor.submit(write_vcard_to_file, vcard, file_path))
+            count += 1
+        for future in pending:
+            future.result()
+    return count
 
 def main():  # pylint: disable=too-many-statements,too-many-branches
     """Main program : running the command line."""
@@ -185,55 +251,27 @@ def main():  # pylint: disable=too-many-statements,too-many-branches
 
         # set the log level and log format accordingly
         log_format = '%(levelname)-8s %(message)s'
-        if args.log_level == 'DEBUG':
-            logging.basicConfig(level=logging.DEBUG, format=log_format)
-        elif args.log_level == 'INFO':
-            logging.basicConfig(level=logging.INFO, format=log_format)
-        elif args.log_level == 'WARNING':
-            logging.basicConfig(level=logging.WARNING, format=log_format)
-        elif args.log_level == 'ERROR':
-            logging.basicConfig(level=logging.ERROR, format=log_format)
-        else:
-            stderr.write("[ERROR] Invalid log level '" + args.log_level + "'\n\n")
-            parser.print_help()
-            sysexit(2)
+        logging.basicConfig(level=getattr(logging, args.log_level), format=log_format)
 
         # Set the extension to use when saving vcard files
         the_vcard_ext = args.vcard_extension
 
-        # no match approx
-        vcardlib.OPTION_NO_MATCH_APPROX = args.no_match_approx
-
-        # match attributes
-        if args.match_attributes and isinstance(args.match_attributes, list):
-            if args.match_attributes != vcardlib.OPTION_MATCH_ATTRIBUTES:
-                vcardlib.OPTION_MATCH_ATTRIBUTES = (
-                    args.match_attributes[len(vcardlib.OPTION_MATCH_ATTRIBUTES):])
-
-        # match approx min length
-        if args.match_min_length and isinstance(args.match_min_length, int):
-            vcardlib.OPTION_MATCH_APPROX_MIN_LENGTH = args.match_min_length
-
-        # match approx same first letter
-        vcardlib.OPTION_MATCH_APPROX_SAME_FIRST_LETTER = not args.no_match_same_first_letter
-
-        # match approx startswith
-        vcardlib.OPTION_MATCH_APPROX_STARTSWITH = args.match_startswith
-
-        # match approx max distance
-        if args.match_max_distance and isinstance(args.match_max_distance, int):
-            vcardlib.OPTION_MATCH_APPROX_MAX_DISTANCE = range(
-                -args.match_max_distance, args.match_max_distance)
-
-        # match ratio
-        if args.match_ratio and isinstance(args.match_ratio, int):
-            vcardlib.OPTION_MATCH_APPROX_RATIO = args.match_ratio
-
-        # french tweaks
-        vcardlib.OPTION_FRENCH_TWEAKS = args.french_tweaks
-
-        # comma auto escape
-        vcardlib.OPTION_DO_NOT_FORCE_ESCAPE_COMMAS = args.do_not_force_escape_commas
+        # match attributes (specified ones are appended to the default ones by argparse)
+        match_attributes = None
+        if args.match_attributes and args.match_attributes != vcardlib.OPTION_MATCH_ATTRIBUTES:
+            match_attributes = args.match_attributes[len(vcardlib.OPTION_MATCH_ATTRIBUTES):]
+
+        # library options (those equal to 0 keep their default value)
+        vcardlib.configure(
+            match_attributes=match_attributes,
+            no_match_approx=args.no_match_approx,
+            match_approx_same_first_letter=not args.no_match_same_first_letter,
+            match_approx_startswith=args.match_startswith,
+            match_approx_min_length=args.match_min_length or None,
+            match_approx_max_distance=args.match_max_distance or None,
+            match_approx_ratio=args.match_ratio or None,
+            french_tweaks=args.french_tweaks,
+            do_not_force_escape_commas=args.do_not_force_escape_commas)
 
         # no space in filename
         OPTION_NO_SPACE_IN_FILENAME = args.no_space_in_filename
@@ -243,7 +281,6 @@ def main():  # pylint: disable=too-many-statements,too-many-branches
         # replacement of invalid chars in filename
         OPTION_REPLACE_INVALID_FILENAME_CHAR_BY = args.rep_invalid_fn_char_by
 
-
         # check DESTDIR argument
         if exists(args.dest_dir):
             stderr.write("[ERROR] Directory '" + args.dest_dir + "' exists. "
@@ -252,20 +289,25 @@ def main():  # pylint: disable=too-many-statements,too-many-branches
             sysexit(2)
         # create DIR
         else:
-            # Make sure args.dest_dir has not ending '/' before adding a new '/' in other steps
-            dirname, subdir = pathsplit(args.dest_dir)
-            if (subdir == ''):
-                args.dest_dir = dirname
+            # Make sure args.dest_dir has no ending '/' (nor '//' or '.' parts)
+            # before adding a new '/' in other steps
+            args.dest_dir = normpath(args.dest_dir)
             makedirs(args.dest_dir)
             logging.info("Created directory '%s'", args.dest_dir)
 
+        # path prefix of every file/dir created in DESTDIR
+        dest_prefix = args.dest_dir + '/'
+
         # check FILES argument
         for arg_file in args.files:
-            if not exists(arg_file):
+            # a single stat per file (instead of one for existence and another one for type)
+            try:
+                arg_file_stat = os_stat(arg_file)
+            except OSError:
                 stderr.write("[ERROR] File '" + arg_file + "' doesn't exist\n\n")
                 parser.print_help()
                 sysexit(2)
-            elif not isfile(arg_file):
+            if not S_ISREG(arg_file_stat.st_mode):
                 stderr.write("[ERROR] '" + arg_file + "' is not a regular file\n\n")
                 parser.print_help()
                 sysexit(2)
@@ -284,70 +326,86 @@ def main():  # pylint: disable=too-many-statements,too-many-branches
             logging.info("\tMATCH_APPROX_RATIO: %s", vcardlib.OPTION_MATCH_APPROX_RATIO)
         logging.info("\tFRENCH_TWEAKS: %s", vcardlib.OPTION_FRENCH_TWEAKS)
 
-        # read/parse individual vCard files
-        vcards = get_vcards_from_files( \
-                args.files, \
-                args.no_fix_and_convert, \
-                args.no_overwrite_names, \
-                args.move_name_parentheses_or_braces_to_note, \
-                args.no_remove_name_in_email \
-        )
-
         # group vcards
         if args.group_vcards or args.merge_vcards:
+
+            # read/parse individual vCard files
+            vcards = get_vcards_from_files( \
+                    args.files, \
+                    args.no_fix_and_convert, \
+                    args.no_overwrite_names, \
+                    args.move_name_parentheses_or_braces_to_note, \
+                    args.no_remove_name_in_email \
+            )
+
             vcards_grouped, vcards_not_grouped = get_vcards_groups(vcards)
 
             # create grouped vCard files in group dirs
             logging.info("Processing '%d' grouped vCard ...", len(vcards_grouped))
-            for g_name, g_list in sorted(vcards_grouped.items()):
+            vcard_files = []
+            groups = [(generate_group_dirname(g_name), g_name, g_list)
+                      for g_name, g_list in vcards_grouped.items()]
+            # sort the groups by their (ASCII) dirname, that is computed only once
+            if args.sort_output:
+                groups.sort(key=itemgetter(0))
+            for g_dirname, g_name, g_list in groups:
                 if len(g_list) > 1:
                     logging.debug("\t%s (%d vcards)", g_name, len(g_list))
-                    d_path = args.dest_dir + "/" + generate_group_dirname(g_name)
+                    d_path = dest_prefix + g_dirname
 
                     # merge
                     if args.merge_vcards:
-                        # collect vcards to merge
-                        vcards_to_merge = []
-                        for key in g_list:
-                            vcards_to_merge.append(vcards[key])
-                        # collect attributes for all vCards
-                        attributes = collect_attributes(vcards_to_merge)
+                        # collect attributes for all vCards to merge
+                        attributes = collect_attributes([vcards[key] for key in g_list])
                         # select a name
                         set_name(attributes)
                         # save the remaining attributes to the merged vCard
                         vcard_merge = build_vcard(attributes)
-                        # write to the file
-                        write_vcard_to_file(vcard_merge, d_path + the_vcard_ext)
+                        # to be written to the file
+                        vcard_files.append((vcard_merge, d_path + the_vcard_ext))
 
                     # group
                     else:
+                        # the dir must exist before writing its files
                         makedirs(d_path)
                         logging.debug("\t%s", d_path)
+                        d_path_slash = d_path + '/'
                         for key in g_list:
                             logging.debug("\t\t%s", key)
-                            write_vcard_to_file(
+                            vcard_files.append((
                                 vcards[key],
-                                d_path + '/' + generate_vcard_filename(key, the_vcard_ext))
+                                d_path_slash + generate_vcard_filename(key, the_vcard_ext)))
                 else: # should not happen
                     raise RuntimeError("Only one vcard in group '" + g_name + "' "
                                        "(should not happen)")
+            write_vcards_to_files(vcard_files)
 
             # create vCard files not grouped in dest dir root
             if vcards_not_grouped:
                 logging.info("Creating '%d' not grouped vCard files (in root dir) ...",
                              len(vcards_not_grouped))
-                for key in vcards_not_grouped:
-                    write_vcard_to_file(
-                        vcards[key],
-                        args.dest_dir + '/' + generate_vcard_filename(key, the_vcard_ext))
+                write_vcards_to_files(
+                    (vcards[key], dest_prefix + generate_vcard_filename(key, the_vcard_ext))
+                    for key in vcards_not_grouped)
 
         # no grouping
-        elif vcards:
+        else:
 
-            # create vCard files not grouped in dest dir root
-            logging.info("Creating '%d' not grouped vCard files (in root dir) ...", len(vcards))
-            for key, vcard in vcards.items():
-                write_vcard_to_file(vcard, args.dest_dir + '/' + generate_vcard_filename(key, the_vcard_ext))
+            # read/parse individual vCard files and create their vCard files in dest dir root
+            # as they come (so they are not all kept in memory)
+            # note: on a parsing failure, the vCard files already created are left in place
+            logging.info("Creating not grouped vCard files (in root dir) as they are parsed "
+                         "(on failure, already created files are kept) ...")
+            vcards_count = write_vcards_to_files(
+                (vcard, dest_prefix + generate_vcard_filename(key, the_vcard_ext))
+                for key, vcard in iter_vcards_from_files( \
+                        args.files, \
+                        args.no_fix_and_convert, \
+                        args.no_overwrite_names, \
+                        args.move_name_parentheses_or_braces_to_note, \
+                        args.no_remove_name_in_email \
+                ))
+            logging.info("Created '%d' not grouped vCard files (in root dir)", vcards_count)
 
 
     # user CTRL-C